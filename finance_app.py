@@ -3,7 +3,36 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 import re
+import io
+import hashlib
+import threading
+import requests
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from typing import NamedTuple
+
+# 可选依赖：长历史趋势图降采样 (未安装时按原样绘制全部数据点)
+try:
+    from plotly_resampler import FigureResampler
+    from plotly_resampler.aggregation import NoGapHandler
+except ImportError:
+    FigureResampler = None
+
+# 趋势图超过该点数时只下发降采样后的数据
+TREND_MAX_POINTS = 1500
+
+# 云端 CSV 最多缓存的 URL 数 (进程内所有会话共享，必须有上限)
+CSV_CACHE_MAX_URLS = 8
+
+# 解析结果、派生统计和图表缓存的条目上限 (同样跨会话共享；每次改里程碑/起始日/
+# 步长/隐私都会新增条目，趋势图还带着全分辨率数据)
+CACHE_MAX_ENTRIES = 8
+
+# 备注解析正则：模块级预编译，避免每次调用重复编译/查缓存
+_SEG_RE = re.compile(r'[;；]')  # 多项并行的分段符
+_KV_RE = re.compile(r'[:：]')  # 大类与明细的分隔符
+_XFER_RE = re.compile(r'理财|买入|基金|转入')  # 资产转移关键词
 
 # --- 页面配置 ---
 st.set_page_config(page_title="Jincheng's 财务看板", layout="wide")
@@ -75,20 +104,21 @@ with tab5:
 
     # 4. 决策逻辑：决定到底用哪个数据
     data_source = None
+    refresh_cloud = False
     
     if uploaded_file:
         # 优先级 1：如果你传了本地文件，强制使用本地文件
         st.info("✅ 模式：正在使用本地上传文件")
-        data_source = uploaded_file
+        # 直接取文件内容 (bytes)
+        data_source = uploaded_file.getvalue()
     elif csv_link_input:
         # 优先级 2：没传文件，但框里有链接，使用链接
         # 简单校验一下是不是网址
         if csv_link_input.startswith("http"):
             st.success("☁️ 模式：正在使用云端链接")
             data_source = csv_link_input
-            # 加个刷新按钮，因为云端数据可能会变
-            if st.button("🔄 立即刷新云端数据", use_container_width=True):
-                st.rerun()
+            # 加个刷新按钮，因为云端数据可能会变 (点击后清缓存重新拉取)
+            refresh_cloud = st.button("🔄 立即刷新云端数据", use_container_width=True)
         else:
             st.warning("⚠️ 链接格式似乎不正确，请以 http 开头")
     else:
@@ -147,7 +177,9 @@ with tab5:
 
     # 整理全局参数
     start_dt = pd.Timestamp(sd_input)
-    job_start_dt = milestones[0]['date'] if milestones else pd.Timestamp(datetime(2023, 6, 14))
+    # 里程碑转为 (纳秒整数, 名称) 元组作为数据缓存的键：表格每次重跑都会生成新的
+    # Timestamp 对象，整数键哈希便宜且内容不变就稳定命中
+    milestones_key = tuple((m['date'].value, m['label']) for m in milestones)
 
 
 # --- 辅助函数：完全保留原版逻辑 ---
@@ -159,7 +191,7 @@ def fmt_money(val, is_kpi=False):
         return f"¥{val:,.0f}"
     return val
 
-def mask_fig(fig, axis='y'):
+def mask_fig(fig, axis='y', privacy=False):
     """
     1. 隐藏图表中的金额轴和提示，适配隐私模式
     2. [核心修改] 适配移动端：锁定坐标轴，防止手指误触导致无法滚动页面
@@ -178,7 +210,7 @@ def mask_fig(fig, axis='y'):
     fig.update_yaxes(fixedrange=True)
 
     # --- B. 隐私模式逻辑 (保留原版) ---
-    if privacy_mode:
+    if privacy:
         if axis == 'y':
             fig.update_yaxes(showticklabels=False, title_text="****")
         elif axis == 'x':
@@ -189,186 +221,447 @@ def mask_fig(fig, axis='y'):
         
     return fig
 
+# --- 云端数据读取：条件请求，未变化时不重复下载 ---
+@st.cache_resource
+def _csv_validators():
+    """按 URL 记录最近下载的 (ETag, Last-Modified, 内容)，跨重跑保留；按最近使用淘汰"""
+    return OrderedDict(), threading.Lock()
+
+@st.cache_data(ttl=3600, max_entries=CSV_CACHE_MAX_URLS, show_spinner=False)
+def fetch_csv_bytes(url):
+    """下载云端 CSV；服务器返回 304 Not Modified 时直接复用上次的内容"""
+    validators, lock = _csv_validators()
+    with lock:
+        cached = validators.get(url)
+    headers = {}
+    if cached:
+        etag, last_modified, _ = cached
+        if etag: headers['If-None-Match'] = etag
+        if last_modified: headers['If-Modified-Since'] = last_modified
+
+    resp = requests.get(url, headers=headers, timeout=30)
+    if resp.status_code == 304 and cached:
+        with lock:
+            if url in validators: validators.move_to_end(url)
+        return cached[2]
+    resp.raise_for_status()
+    etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+    with lock:
+        # 服务器不给校验信息时无法发条件请求，不必留存内容
+        if etag or last_modified:
+            validators[url] = (etag, last_modified, resp.content)
+            validators.move_to_end(url)
+            while len(validators) > CSV_CACHE_MAX_URLS:
+                validators.popitem(last=False)
+        else:
+            validators.pop(url, None)
+    return resp.content
+
 # --- 核心数据处理：完全保留原版算法 ---
-@st.cache_data(ttl=1)
-def load_and_process_data(file, start_date_val, job_start_val):
-    # 支持 URL 读取
-    df = pd.read_csv(file)
+@st.cache_data(ttl=3600, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def read_raw_csv(source_bytes):
+    """解析 CSV 原始内容；单独缓存，修改起始日/里程碑时不必重新解析"""
+    # 只读用到的列并显式指定类型，跳过类型推断；pyarrow 引擎多线程解析
+    # Notes 直接落成 pyarrow 字符串 (标签解析的 .str 操作走 Arrow 内核)；金额保持 numpy float64
+    options = dict(usecols=['Day', 'Bank', 'Invest', 'Notes'],
+                   dtype={'Day': 'float64', 'Bank': 'float64', 'Invest': 'float64',
+                          'Notes': 'string[pyarrow]'})
+    try:
+        return pd.read_csv(io.BytesIO(source_bytes), engine='pyarrow', **options)
+    except pd.errors.ParserError:
+        # 手工编辑的 CSV 常省略行尾空备注 (列数不足)，pyarrow 会拒绝；C 引擎按缺失值补齐
+        return pd.read_csv(io.BytesIO(source_bytes), engine='c', **options)
+
+def load_and_process_data(source_bytes, start_date_val, milestones_key):
+    # 上传文件与云端链接均以 CSV 内容 (bytes) 传入，缓存按内容命中
+    df = read_raw_csv(source_bytes)
     base_date = pd.Timestamp(start_date_val)
     # 还原真实日期
-    df['Date'] = df['Day'].apply(lambda x: base_date + timedelta(days=float(x)))
+    df['Date'] = base_date + pd.to_timedelta(df['Day'], unit='D')
+    # 约定：返回的 df 按 Date 升序 (稳定排序)，下游计算直接依赖该顺序，不再重复排序
+    df = df.sort_values('Date', kind='stable').reset_index(drop=True)
     
     # 基础清洗
-    df['Bank'] = df['Bank'].fillna(0).astype(float)
-    df['Invest'] = df['Invest'].fillna(0).astype(float)
+    df[['Bank', 'Invest']] = df[['Bank', 'Invest']].fillna(0.0)
     df['Total_Assets'] = df['Bank'] + df['Invest']
     df['Change'] = df['Total_Assets'].diff().fillna(0)
-    df['Notes'] = df['Notes'].fillna('').astype(str)
+    df['Notes'] = df['Notes'].fillna('')
     
-    # --- 自适应标签解析逻辑 (原版) ---
-    def adaptive_tagging(row):
-        note = str(row['Notes']).strip()
-        change = row['Change']
-        if change == 0 and not note: return '无变动'
-        
-        import re
-        segments = re.split('[;；]', note)
-        valid_cats = []
-        for s in segments:
-            parts = re.split('[:：]', s)
-            cat = parts[0].strip()
-            # 排除非财务统计词
-            if cat and cat not in ['里程碑', '备注', '备忘', '2025', '2026']:
-                valid_cats.append(cat)
-        
-        # 资产转移检测
-        if any(k in note for k in ['理财', '买入', '基金', '转入']) and abs(change) < 10:
-            return '资产转移'
-
-        res_tag = valid_cats[0] if valid_cats else "其他"
-        prefix = "📈 收入:" if change > 0 else "💸 支出:"
-        return f"{prefix}{res_tag}"
-
-    df['Tag'] = df.apply(adaptive_tagging, axis=1)
+    # --- 自适应标签解析逻辑 (向量化，规则同原版) ---
+    notes = df['Notes'].str.strip()
+    change = df['Change']
+
+    # 按分号拆段，每段取冒号前的大类，保留每行第一个有效大类
+    cats = notes.str.split(_SEG_RE).explode()
+    cats = cats.str.split(_KV_RE, n=1).str[0].str.strip()
+    # 排除非财务统计词
+    cats = cats[(cats != '') & ~cats.isin(['里程碑', '备注', '备忘', '2025', '2026'])]
+    cat = cats.groupby(level=0).first().reindex(df.index, fill_value='其他')
+
+    is_noop = (change == 0) & (notes == '')
+    # 资产转移检测
+    is_transfer = notes.str.contains(_XFER_RE) & (change.abs() < 10)
+
+    # 逐行只产出整数编码 (类型 × 大类)，标签字符串只为去重后的组合拼接一次
+    kinds = np.array(['无变动', '资产转移', '📈 收入:', '💸 支出:'], dtype=object)
+    kind = np.select([is_noop, is_transfer, change > 0], [0, 1, 2], default=3)
+    cat_codes, cat_names = pd.factorize(cat)
+    cat_codes = np.where(kind < 2, 0, cat_codes)
+    pairs, tag_codes = np.unique(kind * max(len(cat_names), 1) + cat_codes, return_inverse=True)
+    pair_kind, pair_cat = np.divmod(pairs, max(len(cat_names), 1))
+    tag_names = np.where(pair_kind < 2, kinds[pair_kind],
+                         kinds[pair_kind] + np.asarray(cat_names, dtype=object)[pair_cat])
+    # 直接得到 category 列，类别按字典序排列 (与 astype('category') 一致)
+    tags = pd.Categorical.from_codes(tag_codes, categories=tag_names)
+    df['Tag'] = tags.reorder_categories(sorted(tag_names))
     
-    # --- 动态阶段划分逻辑 (原版) ---
-    def assign_stage_dynamic(d):
-        current_label = "初始阶段"
-        stage_start_date = milestones[0]['date'] if milestones else d
-        
-        for m in milestones:
-            if d >= m['date']:
-                current_label = m['label']
-                stage_start_date = m['date']
-            else:
-                break
-        
-        # 计算在该阶段内是第几年
-        years_passed = (d - stage_start_date).days // 365
-        return f"{current_label} (第{years_passed + 1}年)"
-    
-    df['Stage'] = df['Date'].apply(assign_stage_dynamic)
+    # --- 动态阶段划分逻辑 (向量化，规则同原版) ---
+    dates = df['Date'].to_numpy(dtype='datetime64[ns]')
+    # 阶段名称表：下标 0 为初始阶段，其后依次为各里程碑
+    stage_labels = np.array(["初始阶段"] + [label for _, label in milestones_key], dtype=object)
+    if milestones_key:
+        ms_dates = np.array([d for d, _ in milestones_key], dtype='datetime64[ns]')
+        # 每行所处的里程碑下标，-1 表示早于第一个里程碑
+        idx = np.searchsorted(ms_dates, dates, side='right') - 1
+        # 初始阶段仍以第一个里程碑为起点 (原版口径)
+        starts = ms_dates[np.clip(idx, 0, None)]
+    else:
+        idx = np.full(len(df), -1)
+        starts = dates
+
+    # 计算在该阶段内是第几年
+    years_passed = (dates - starts) // np.timedelta64(1, 'D') // 365
+
+    # 逐行只有 (阶段下标, 第几年) 两个整数，阶段名称只为去重后的组合拼接一次
+    year_min = years_passed.min()
+    span = years_passed.max() - year_min + 1
+    pairs, pair_codes = np.unique((idx + 1) * span + (years_passed - year_min), return_inverse=True)
+    pair_stage, pair_year = np.divmod(pairs, span)
+    names = [f"{stage_labels[i]} (第{y + year_min + 1}年)" for i, y in zip(pair_stage, pair_year)]
+    # 同名里程碑可能拼出相同名称，去重后得到 category 编码 (类别按时间先后排列)
+    name_codes, stage_names = pd.factorize(np.array(names, dtype=object))
+    df['Stage'] = pd.Categorical.from_codes(name_codes[pair_codes], categories=stage_names)
     
-    # 月度数据
-    df_res = df.set_index('Date')['Total_Assets'].resample('ME').last()
+    # 月度数据：按自然月分组取最后值，再补齐空缺月份 (与 resample('ME') 口径一致)
+    month_key = df['Date'].to_numpy(dtype='datetime64[ns]').astype('datetime64[M]')
+    df_res = df['Total_Assets'].groupby(month_key).last()
+    df_res.index = pd.to_datetime(df_res.index) + pd.offsets.MonthEnd(0)
+    df_res = df_res.reindex(pd.date_range(df_res.index[0], df_res.index[-1], freq='ME'))
     monthly_diff = df_res.diff().fillna(0)
     
-    # 季节性数据
-    season_df = pd.DataFrame({'Net_Change': monthly_diff})
-    season_df['Year'] = season_df.index.year
-    season_df['Month'] = season_df.index.month
-    season_pivot = season_df.pivot(index='Year', columns='Month', values='Net_Change')
-    
-    # 为绘图映射中文列名
-    df['资产类型:银行'] = df['Bank']
-    df['资产类型:投资'] = df['Invest']
+    # 季节性数据：直接按 (年, 月) 下标写入二维网格，省去 pivot
+    years, yidx = np.unique(monthly_diff.index.year, return_inverse=True)
+    months, midx = np.unique(monthly_diff.index.month, return_inverse=True)
+    grid = np.full((len(years), len(months)), np.nan)
+    grid[yidx, midx] = monthly_diff.to_numpy()
+    season_pivot = pd.DataFrame(grid, index=pd.Index(years, name='Year'),
+                                columns=pd.Index(months, name='Month'))
     
     return df, monthly_diff, season_pivot
 
 # --- 速率计算逻辑 (原版) ---
-def calculate_milestone_velocity(df, step):
-    milestones_res = []
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def calculate_milestone_velocity(_df, df_key, step):
+    # 与图表相同按内容键缓存：_df 不参与哈希，避免每次重跑整表哈希 (大表还只抽样)
+    df = _df
+    # df 已在加载时按 Date 排好序
     start_val = df['Total_Assets'].min()
     current_target = (start_val // step + 1) * step
-    last_date = df['Date'].iloc[0]
-    sorted_df = df.sort_values('Date')
+
+    # 历史最高资产单调不减，每个目标的首次达成位置即其二分插入点
+    cum_max = np.maximum.accumulate(df['Total_Assets'].to_numpy())
+    targets = np.arange(current_target, df['Total_Assets'].max() + step, step)
+    hit_idx = np.searchsorted(cum_max, targets, side='left')
+    targets, hit_idx = targets[hit_idx < len(cum_max)], hit_idx[hit_idx < len(cum_max)]
+
+    reach_dates = df['Date'].to_numpy()[hit_idx]
+    days_taken = np.diff(reach_dates, prepend=df['Date'].to_numpy()[:1])
+    days_taken = (days_taken // np.timedelta64(1, 'D')).clip(min=1)
+
+    # 只返回原始数值，里程碑标签在渲染时按隐私模式生成
+    return pd.DataFrame({
+        "Target": targets,
+        "所用天数": days_taken,
+        "达成日期": pd.DatetimeIndex(reach_dates).strftime("%Y-%m-%d")
+    })
+
+# --- 派生统计 ---
+def content_key(source_bytes, start_dt, milestones_key):
+    """数据身份：CSV 内容摘要 + 起始日 + 里程碑，作为图表缓存的键 (任一处改动都会换键)"""
+    return (hashlib.sha1(source_bytes).hexdigest(), pd.Timestamp(start_dt).value, milestones_key)
+
+def top_tables(df):
+    """一次性算出分类排行与收入/支出 Top 10"""
+    # 直接在分组后的 Series 上取首尾 10 名，按 Tag 去重 (分类数不足 20 时两端会重叠)
+    sums = df.loc[df['Change'] != 0].groupby('Tag', observed=True)['Change'].sum()
+    picked = pd.concat([sums.nsmallest(10), sums.nlargest(10)])
+    tag_stats = picked[~picked.index.duplicated()].sort_values().rename_axis('Tag').reset_index()
+
+    cols = ['Date', 'Change', 'Notes', 'Tag']
+    top_inc = df[df['Change'] > 0].nlargest(10, 'Change')[cols]
+    top_inc['Date'] = top_inc['Date'].dt.strftime('%Y-%m-%d')
+    top_exp = df[df['Change'] < 0].nsmallest(10, 'Change')[cols]
+    top_exp['Date'] = top_exp['Date'].dt.strftime('%Y-%m-%d')
+    return tag_stats, top_inc, top_exp
+
+def yearly_summary(df):
+    """按自然年一次聚合首末资产与日期，算出日均增长"""
+    agg = df.groupby(df['Date'].dt.year).agg(
+        first_ta=('Total_Assets', 'first'), last_ta=('Total_Assets', 'last'),
+        dmin=('Date', 'min'), dmax=('Date', 'max')
+    )
+    growth = agg['last_ta'] - agg['first_ta']
+    days = (agg['dmax'] - agg['dmin']).dt.days
+    velocity = growth / days.where(days > 0)
+    valid = velocity.notna()
+    return pd.DataFrame({
+        "年份": agg.index[valid].astype(str),
+        "日均增长": velocity[valid].round(1).to_numpy(),
+        "年累计增长": growth[valid].to_numpy()
+    })
+
+class KPIs(NamedTuple):
+    """顶部 KPI 与阶段预测用到的全部数值 (与隐私模式无关)"""
+    curr_total: float
+    curr_stage: str
+    last_change: float
+    stage_velocity: float
+    display_velocity: float
+    cash_ratio: float
+
+def compute_kpis(df):
+    # 最后一行只取一次；df 按 Date 排序，各切片的末行都是它，首行即最早日期
+    last = df.iloc[-1]
+    curr_total = last['Total_Assets']
+    curr_stage = last['Stage']
     
-    while current_target <= df['Total_Assets'].max():
-        reach_row = sorted_df[sorted_df['Total_Assets'] >= current_target].head(1)
-        if not reach_row.empty:
-            curr_date = reach_row['Date'].iloc[0]
-            days_taken = (curr_date - last_date).days
-            if days_taken < 1: days_taken = 1
-            
-            m_label = "****" if privacy_mode else f"{int(current_target/10000)}w"
-            
-            milestones_res.append({
-                "里程碑": m_label,
-                "所用天数": days_taken,
-                "达成日期": curr_date.strftime("%Y-%m-%d")
-            })
-            last_date = curr_date
-            current_target += step
-        else:
-            break
-    return pd.DataFrame(milestones_res)
+    # 近一年增速计算 (二分定位起点后切片，不做整列比较)
+    one_year_ago = last['Date'] - timedelta(days=365)
+    recent_year_df = df.iloc[df['Date'].searchsorted(one_year_ago, side='left'):]
+    if len(recent_year_df) > 1:
+        first = recent_year_df.iloc[0]
+        recent_growth = curr_total - first['Total_Assets']
+        recent_days = (last['Date'] - first['Date']).days
+        display_velocity = recent_growth / recent_days if recent_days > 0 else 0
+    else:
+        display_velocity = 0
+    
+    # 计算当前阶段速率 (原版逻辑)：比较整数编码找阶段首行，不做字符串比较和布尔切片
+    # 同名里程碑可能复用更早的编码，编码不保证单调，故不用二分
+    codes = df['Stage'].cat.codes.to_numpy()
+    start = int(np.argmax(codes == codes[-1]))
+    stage_velocity = 0
+    if start < len(df) - 1:
+        first = df.iloc[start]
+        stage_growth = curr_total - first['Total_Assets']
+        stage_days = (last['Date'] - first['Date']).days
+        if stage_days > 0: stage_velocity = stage_growth / stage_days
+    
+    return KPIs(
+        curr_total=curr_total,
+        curr_stage=curr_stage,
+        last_change=last['Change'],
+        stage_velocity=stage_velocity,
+        display_velocity=display_velocity,
+        cash_ratio=last['Bank'] / curr_total,
+    )
+
+@dataclass(frozen=True)
+class DashState:
+    """一次数据加载对应的全部预计算结果，主程序只负责格式化和渲染"""
+    df: pd.DataFrame
+    monthly_diff: pd.Series
+    season_pivot: pd.DataFrame
+    top_inc: pd.DataFrame
+    top_exp: pd.DataFrame
+    tag_stats: pd.DataFrame
+    yearly_summary: pd.DataFrame
+    kpis: KPIs
+    key: tuple
+
+@st.cache_data(ttl=3600, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def build_dashboard_state(source_bytes, start_dt, milestones_key):
+    """解析 + 全部聚合只在数据/起始日/里程碑变化时执行一次"""
+    df, monthly_diff, season_pivot = load_and_process_data(source_bytes, start_dt, milestones_key)
+    tag_stats, top_inc, top_exp = top_tables(df)
+    return DashState(
+        df=df, monthly_diff=monthly_diff, season_pivot=season_pivot,
+        top_inc=top_inc, top_exp=top_exp, tag_stats=tag_stats,
+        yearly_summary=yearly_summary(df), kpis=compute_kpis(df),
+        key=content_key(source_bytes, start_dt, milestones_key)
+    )
+
+# --- 图表构建：按 (数据指纹, 隐私模式, 相关参数) 缓存，切换标签页/无关控件不再重建 ---
+@st.cache_resource(ttl=3600, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def build_trend_fig(_df, df_key, privacy, milestones_key):
+    df = _df
+    # 恢复原版配色和设置 (绘图时才映射中文列名，不在缓存数据里复制两列)
+    # 金额在缓存数据里保持 float64 (累加/差分不丢分)，只把发给浏览器的曲线降为 float32
+    plot_df = df[['Date', 'Bank', 'Invest']].astype({'Bank': np.float32, 'Invest': np.float32})
+    plot_df = plot_df.rename(columns={'Bank': '资产类型:银行', 'Invest': '资产类型:投资'})
+    fig_trend = px.area(plot_df, x='Date', y=['资产类型:银行', '资产类型:投资'], 
+                         color_discrete_map={"资产类型:银行": "#7fb3d5", "资产类型:投资": "#5b5ea6"},
+                         labels={"value": "金额 (元)", "Date": "日期", "variable": "资产类型"})
+    
+    # 长历史只向浏览器发送 LTTB 降采样后的点，首屏渲染不再随行数增长
+    if FigureResampler is not None and len(df) > TREND_MAX_POINTS:
+        fig_trend = FigureResampler(fig_trend, default_n_shown_samples=TREND_MAX_POINTS,
+                                    default_gap_handler=NoGapHandler(),
+                                    resampled_trace_prefix_suffix=("", ""),
+                                    show_mean_aggregation_size=False)
+        # 两条堆叠曲线的采样点不完全相同，按插值对齐堆叠
+        fig_trend.update_traces(stackgaps='interpolate')
+    
+    # 恢复辅助线和文字标注：先拼好全部 shapes/annotations，一次性写入布局
+    first_ns = df['Date'].iloc[0].value
+    shown = [(ms_ns, ms_label) for ms_ns, ms_label in milestones_key if ms_ns >= first_ns]
+    shapes = [dict(type="line", x0=ms_ns / 1e6, x1=ms_ns / 1e6,
+                   xref="x", y0=0, y1=1, yref="y domain",
+                   line=dict(dash="dash", color="orange"), opacity=0.7)
+              for ms_ns, _ in shown]
+    annotations = [dict(x=pd.Timestamp(ms_ns), y=1, yref="paper", text=ms_label,
+                        showarrow=False, font=dict(color="orange"),
+                        textangle=-90, xanchor="left", yanchor="top")
+                   for ms_ns, ms_label in shown]
+    # uirevision 固定：重跑只换数据/样式时保留缩放状态，前端不做整图重排
+    fig_trend.update_layout(shapes=shapes, annotations=annotations, uirevision='static')
+    
+    return mask_fig(fig_trend, axis='y', privacy=privacy)
+
+@st.cache_resource(ttl=3600, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def build_monthly_fig(_monthly_diff, df_key, privacy):
+    m_data = _monthly_diff.reset_index()
+    m_data.columns = ['月份', '金额']
+    # 恢复原版色阶
+    fig_monthly = px.bar(m_data, x='月份', y='金额', color='金额',
+                          labels={"金额": "净盈亏 (元)", "月份": "时间"},
+                          color_continuous_scale='RdYlGn')
+    
+    fig_monthly.update_layout(uirevision='static')
+    mask_fig(fig_monthly, axis='y', privacy=privacy)
+    if privacy: fig_monthly.update_coloraxes(showscale=False)
+    return fig_monthly
+
+@st.cache_resource(ttl=3600, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def build_velocity_fig(_v_df, df_key, step, privacy):
+    v_df = _v_df.copy()
+    v_df['里程碑'] = np.where(privacy, "****",
+                              (v_df['Target'] / 10000).astype(int).astype(str) + "w")
+    fig_v = px.bar(v_df, x='里程碑', y='所用天数', text='所用天数',
+                   hover_data=['达成日期'],
+                   labels={"所用天数": "耗时 (天)", "里程碑": "资产里程碑"},
+                   color='所用天数', color_continuous_scale='RdYlBu_r')
+    return mask_fig(fig_v, axis='y', privacy=privacy)
+
+@st.cache_resource(ttl=3600, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def build_year_fig(_y_df, df_key, privacy):
+    fig_year = px.bar(
+        _y_df, x='年份', y='日均增长', text='日均增长',
+        labels={"日均增长": "日均增长 (元/天)", "年份": "年份"},
+        color='日均增长', color_continuous_scale='GnBu'
+    )
+    mask_fig(fig_year, axis='y', privacy=privacy)
+    fig_year.update_xaxes(dtick=1) # 强制显示整数年份
+    
+    if privacy:
+        fig_year.update_traces(texttemplate="****")
+        fig_year.update_yaxes(showticklabels=False, title_text="****")
+        fig_year.update_coloraxes(showscale=False)
+    else:
+        fig_year.update_traces(textposition='outside')
+    return fig_year
+
+@st.cache_resource(ttl=3600, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def build_tag_fig(_tag_stats, df_key, privacy):
+    # 恢复原版 Bar chart 设置
+    fig_tag = px.bar(
+        _tag_stats, 
+        x='Change', 
+        y='Tag', 
+        orientation='h', 
+        labels={"Change": "净额 (元)", "Tag": "分类"},
+        color='Change', 
+        color_continuous_scale='RdBu', 
+        color_continuous_midpoint=0, 
+        height=600
+    )
+    
+    mask_fig(fig_tag, axis='x', privacy=privacy)
+    if privacy: fig_tag.update_coloraxes(showscale=False)
+    return fig_tag
+
+@st.cache_resource(ttl=3600, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def build_heat_fig(_season_pivot, df_key, privacy):
+    text_auto_val = False if privacy else '.1f'
+    
+    fig_heat = px.imshow(_season_pivot.fillna(0)/1000, 
+                         text_auto=text_auto_val, 
+                         labels={"color": "净值 (k)", "x": "月份", "y": "年份"},
+                         color_continuous_scale='RdYlGn', aspect="auto")
+    mask_fig(fig_heat, axis='y', privacy=privacy)
+    # 恢复原版：强制显示整数年份
+    fig_heat.update_yaxes(dtick=1)
+    fig_heat.update_xaxes(dtick=1)
+
+    if privacy:
+        fig_heat.update_coloraxes(showscale=False)
+        fig_heat.update_traces(hovertemplate="年份: %{y}<br>月份: %{x}<br>****")
+        fig_heat.update_traces(texttemplate="")
+    return fig_heat
 
 # =========================================================
 #  主程序执行逻辑
 # =========================================================
 if data_source:
-    df, monthly_diff, season_pivot = load_and_process_data(data_source, start_dt, job_start_dt)
+    if refresh_cloud:
+        # 云端数据可能已变：只清本链接的下载缓存，重新发条件请求 (未变化时 304)；
+        # 解析、派生统计和图表都按内容缓存，数据变了键就变，没变则继续命中
+        try:
+            fetch_csv_bytes.clear(data_source)
+        except TypeError:
+            # 旧版 Streamlit 的 clear() 不接受参数，只能清空整个下载层
+            fetch_csv_bytes.clear()
+    # 云端链接先取回内容 (条件请求)，与上传文件走同一条按内容缓存的处理路径
+    source_bytes = fetch_csv_bytes(data_source) if isinstance(data_source, str) else data_source
+    state = build_dashboard_state(source_bytes, start_dt, milestones_key)
+    df, monthly_diff, season_pivot, kpis = state.df, state.monthly_diff, state.season_pivot, state.kpis
+    df_key = state.key
     
     # --- 1. 顶部 KPI 看板 (填充占位符) ---
     with kpi_placeholder:
         title_goal = "****" if privacy_mode else f"¥{target_goal:,.0f}"
         st.subheader(f"📊 个人财务看板 (目标: {title_goal})")
         
-        # 计算核心指标
-        curr_total = df['Total_Assets'].iloc[-1]
-        curr_stage = df['Stage'].iloc[-1]
-        last_change = df['Change'].iloc[-1]
-        
-        # 近一年增速计算
-        one_year_ago = df['Date'].iloc[-1] - timedelta(days=365)
-        recent_year_df = df[df['Date'] >= one_year_ago]
-        if len(recent_year_df) > 1:
-            recent_growth = recent_year_df['Total_Assets'].iloc[-1] - recent_year_df['Total_Assets'].iloc[0]
-            recent_days = (recent_year_df['Date'].max() - recent_year_df['Date'].min()).days
-            display_velocity = recent_growth / recent_days if recent_days > 0 else 0
-        else:
-            display_velocity = 0
-
+        # 核心指标已在缓存中算好，这里只做格式化
+        curr_total = kpis.curr_total
         kpi_total = fmt_money(curr_total, True)
-        kpi_change = "****" if privacy_mode else f"{last_change:+,.0f}"
+        kpi_change = "****" if privacy_mode else f"{kpis.last_change:+,.0f}"
 
         # 移动端 2x2 布局，但保留原版所有数据精度
         row1 = st.columns(2)
         row1[0].metric("当前总资产", kpi_total, f"最新: {kpi_change}")
-        row1[1].metric("当前阶段", curr_stage)
+        row1[1].metric("当前阶段", kpis.curr_stage)
         
         if privacy_mode:
             vel_str = "**** /天"
         else:
-            vel_str = f"¥{display_velocity:,.1f} /天"
+            vel_str = f"¥{kpis.display_velocity:,.1f} /天"
             
         row2 = st.columns(2)
         row2[0].metric("近365日均积累", vel_str)
-        row2[1].metric("现金占比", f"{(df['Bank'].iloc[-1]/curr_total)*100:.1f}%")
+        row2[1].metric("现金占比", f"{kpis.cash_ratio*100:.1f}%")
         st.divider()
 
     # --- 2. Tab 1: 趋势与月盈亏 (恢复原版图表配置) ---
     with tab1:
         st.subheader("📈 资产演变趋势")
-        # 恢复原版配色和设置
-        fig_trend = px.area(df, x='Date', y=['资产类型:银行', '资产类型:投资'], 
-                             color_discrete_map={"资产类型:银行": "#7fb3d5", "资产类型:投资": "#5b5ea6"},
-                             labels={"value": "金额 (元)", "Date": "日期", "variable": "资产类型"})
-        
-        # 恢复辅助线和文字标注
-        for m in milestones:
-            if m['date'] >= df['Date'].min():
-                fig_trend.add_vline(x=m['date'].timestamp() * 1000, 
-                                   line_dash="dash", line_color="orange", opacity=0.7)
-                fig_trend.add_annotation(x=m['date'], y=1, yref="paper", text=m['label'], 
-                                         showarrow=False, font=dict(color="orange"), 
-                                         textangle=-90, xanchor="left", yanchor="top")
-        
-        mask_fig(fig_trend, axis='y')
+        fig_trend = build_trend_fig(df, df_key, privacy_mode, milestones_key)
         st.plotly_chart(fig_trend, use_container_width=True, config={'displayModeBar': False})
         
         st.divider()
         
         st.subheader("🌔 月度净盈亏")
-        m_data = monthly_diff.reset_index()
-        m_data.columns = ['月份', '金额']
-        # 恢复原版色阶
-        fig_monthly = px.bar(m_data, x='月份', y='金额', color='金额',
-                              labels={"金额": "净盈亏 (元)", "月份": "时间"},
-                              color_continuous_scale='RdYlGn')
-        
-        mask_fig(fig_monthly, axis='y')
-        if privacy_mode: fig_monthly.update_coloraxes(showscale=False)
+        fig_monthly = build_monthly_fig(monthly_diff, df_key, privacy_mode)
         st.plotly_chart(fig_monthly, use_container_width=True, config={'displayModeBar': False})
 
     # --- 3. Tab 2: 进阶速率 (恢复原版) ---
@@ -376,13 +669,9 @@ if data_source:
         step_label = "****" if privacy_mode else f"{int(velocity_step/10000)}w"
         st.subheader(f"⏱️ 财富进阶速率 (步长: {step_label})")
         
-        v_df = calculate_milestone_velocity(df, velocity_step)
+        v_df = calculate_milestone_velocity(df, df_key, velocity_step)
         if not v_df.empty:
-            fig_v = px.bar(v_df, x='里程碑', y='所用天数', text='所用天数',
-                           hover_data=['达成日期'],
-                           labels={"所用天数": "耗时 (天)", "里程碑": "资产里程碑"},
-                           color='所用天数', color_continuous_scale='RdYlBu_r')
-            mask_fig(fig_v, axis='y')
+            fig_v = build_velocity_fig(v_df, df_key, velocity_step, privacy_mode)
             st.plotly_chart(fig_v, use_container_width=True, config={'displayModeBar': False})            
         else:
             st.info("数据跨度不足。")        
@@ -390,69 +679,22 @@ if data_source:
         st.divider()
         st.subheader("🗓️ 年度平均存钱速率")
 
-        df['Year'] = df['Date'].dt.year
-        yearly_summary = []
-        for year, group in df.groupby('Year'):
-            if len(group) > 1:
-                growth = group['Total_Assets'].iloc[-1] - group['Total_Assets'].iloc[0]
-                days = (group['Date'].max() - group['Date'].min()).days
-                if days > 0:
-                    velocity = growth / days
-                    yearly_summary.append({
-                        "年份": str(year), 
-                        "日均增长": round(velocity, 1),
-                        "年累计增长": growth
-                    })
-        
-        y_df = pd.DataFrame(yearly_summary)
+        y_df = state.yearly_summary
         if not y_df.empty:
-            fig_year = px.bar(
-                y_df, x='年份', y='日均增长', text='日均增长',
-                labels={"日均增长": "日均增长 (元/天)", "年份": "年份"},
-                color='日均增长', color_continuous_scale='GnBu'
-            )
-            mask_fig(fig_year, axis='y')
-            fig_year.update_xaxes(dtick=1) # 强制显示整数年份
-            
-            if privacy_mode:
-                fig_year.update_traces(texttemplate="****")
-                fig_year.update_yaxes(showticklabels=False, title_text="****")
-                fig_year.update_coloraxes(showscale=False)
-            else:
-                fig_year.update_traces(textposition='outside')
-            
+            fig_year = build_year_fig(y_df, df_key, privacy_mode)
             st.plotly_chart(fig_year, use_container_width=True, config={'displayModeBar': False})
             # st.caption("注：日均增长 = (当年最后一天总资产 - 当年第一天总资产) / 当年记录天数")
 
     # --- 4. Tab 3: 收支与分类 (恢复被删减的数据表) ---
     with tab3:
         st.subheader("📊 账目分类统计")
-        full_stats = df[df['Change'] != 0].groupby('Tag')['Change'].sum().reset_index()
-        
-        top_exp_tags = full_stats.nsmallest(10, 'Change')
-        top_inc_tags = full_stats.nlargest(10, 'Change')
-        tag_stats = pd.concat([top_exp_tags, top_inc_tags]).drop_duplicates().sort_values('Change')
-        
-        # 恢复原版 Bar chart 设置
-        fig_tag = px.bar(
-            tag_stats, 
-            x='Change', 
-            y='Tag', 
-            orientation='h', 
-            labels={"Change": "净额 (元)", "Tag": "分类"},
-            color='Change', 
-            color_continuous_scale='RdBu', 
-            color_continuous_midpoint=0, 
-            height=600
-        )
-        
-        mask_fig(fig_tag, axis='x')
-        if privacy_mode: fig_tag.update_coloraxes(showscale=False)
+        fig_tag = build_tag_fig(state.tag_stats, df_key, privacy_mode)
         st.plotly_chart(fig_tag, use_container_width=True, config={'displayModeBar': False})
         
         st.divider()
         
         # === 重点恢复：原版的详细数据表 ===
+        # 表格原始数据已缓存，隐私格式化只在展示时进行
         c_left, c_right = st.columns(2)
         
         def display_df_masked(in_df):
@@ -465,29 +707,19 @@ if data_source:
 
         with c_left:
             st.subheader("📈 收入 Top 10")
-            top_inc = df[df['Change'] > 0].nlargest(10, 'Change')[['Date', 'Change', 'Notes', 'Tag']]
-            top_inc['Date'] = top_inc['Date'].dt.strftime('%Y-%m-%d')
-            st.dataframe(display_df_masked(top_inc), use_container_width=True)
+            st.dataframe(display_df_masked(state.top_inc), use_container_width=True)
             
         with c_right:
             st.subheader("💸 支出 Top 10")
-            top_exp = df[df['Change'] < 0].nsmallest(10, 'Change')[['Date', 'Change', 'Notes', 'Tag']]
-            top_exp['Date'] = top_exp['Date'].dt.strftime('%Y-%m-%d')
-            st.dataframe(display_df_masked(top_exp), use_container_width=True)
+            st.dataframe(display_df_masked(state.top_exp), use_container_width=True)
 
     # --- 5. Tab 4: 预测与热力图 (恢复原版细节) ---
     with tab4:
-        curr_stage_name = df['Stage'].iloc[-1]
+        curr_stage_name = kpis.curr_stage
         st.subheader(f"🚀 基于【{curr_stage_name}】的里程碑预测")
         
-        # 计算当前阶段速率 (原版逻辑)
-        stage_df = df[df['Stage'] == curr_stage_name]
-        stage_velocity = 0
-        if len(stage_df) > 1:
-            stage_growth = stage_df['Total_Assets'].iloc[-1] - stage_df['Total_Assets'].iloc[0]
-            stage_days = (stage_df['Date'].max() - stage_df['Date'].min()).days
-            if stage_days > 0: stage_velocity = stage_growth / stage_days
-        
+        # 当前阶段速率已在缓存中算好 (原版逻辑)
+        stage_velocity = kpis.stage_velocity
         if stage_velocity > 0:
             remaining = target_goal - curr_total
             if remaining > 0:
@@ -510,22 +742,7 @@ if data_source:
         st.divider()
         st.subheader("🔥 季节性热力图 (单位: k)")
         if not season_pivot.empty:
-            text_auto_val = False if privacy_mode else '.1f'
-            
-            fig_heat = px.imshow(season_pivot.fillna(0)/1000, 
-                                 text_auto=text_auto_val, 
-                                 labels={"color": "净值 (k)", "x": "月份", "y": "年份"},
-                                 color_continuous_scale='RdYlGn', aspect="auto")
-            mask_fig(fig_heat, axis='y')
-            # 恢复原版：强制显示整数年份
-            fig_heat.update_yaxes(dtick=1)
-            fig_heat.update_xaxes(dtick=1)
-
-            if privacy_mode:
-                fig_heat.update_coloraxes(showscale=False)
-                fig_heat.update_traces(hovertemplate="年份: %{y}<br>月份: %{x}<br>****")
-                fig_heat.update_traces(texttemplate="")
-                
+            fig_heat = build_heat_fig(season_pivot, df_key, privacy_mode)
             st.plotly_chart(fig_heat, use_container_width=True, config={'displayModeBar': False})
 
 else: